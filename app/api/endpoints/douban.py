@@ -1,6 +1,17 @@
-from typing import List, Any
-
-from fastapi import APIRouter, Depends, Response
+import asyncio
+import gzip
+import hashlib
+import re
+from functools import partial
+from typing import List, Any, Dict, Optional, Iterator, Tuple, Callable
+
+import requests
+from cachetools import TTLCache
+from fastapi import APIRouter, Depends, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, ORJSONResponse
+from fastapi.routing import APIRoute
+from requests.adapters import HTTPAdapter
 
 from app import schemas
 from app.chain.douban import DoubanChain
@@ -10,31 +21,236 @@ from app.core.security import verify_token
 from app.schemas import MediaType
 from app.utils.http import RequestUtils
 
-router = APIRouter()
+
+class ETagGzipRoute(APIRoute):
+    """
+    为成功的GET响应添加ETag，客户端缓存未变化时返回304，
+    客户端支持时对超过1KB的响应进行gzip压缩
+    """
+
+    def get_route_handler(self) -> Callable:
+        original_route_handler = super().get_route_handler()
+
+        async def custom_route_handler(request: Request) -> Response:
+            response = await original_route_handler(request)
+            if request.method != "GET" \
+                    or response.status_code != 200 \
+                    or isinstance(response, StreamingResponse):
+                return response
+            etag = 'W/"%s"' % hashlib.blake2s(response.body, digest_size=8).hexdigest()
+            if_none_match = request.headers.get("if-none-match")
+            if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+                headers = {"ETag": etag}
+                if response.headers.get("Cache-Control"):
+                    headers["Cache-Control"] = response.headers.get("Cache-Control")
+                return Response(status_code=304, headers=headers)
+            response.headers["ETag"] = etag
+            if len(response.body) >= 1024 \
+                    and not response.headers.get("Content-Encoding"):
+                # 同一地址会按客户端返回压缩或未压缩的内容，都需要声明
+                response.headers["Vary"] = "Accept-Encoding"
+                if "gzip" in request.headers.get("accept-encoding", ""):
+                    response.body = gzip.compress(response.body, compresslevel=5)
+                    response.headers["Content-Encoding"] = "gzip"
+                    response.headers["Content-Length"] = str(len(response.body))
+            return response
+
+        return custom_route_handler
+
+
+router = APIRouter(route_class=ETagGzipRoute, default_response_class=ORJSONResponse)
+
+# 豆瓣处理链，单例
+_douban_chain = DoubanChain()
+
+# 豆瓣图片代理会话，复用到图片服务器的连接
+_img_session = requests.Session()
+_img_session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=50))
+_img_session.mount("http://", _img_session.get_adapter("https://"))
+
+# 豆瓣默认海报（无海报时的占位图）
+_MOVIE_POSTER_BLACKLIST = re.compile(r"movie_large\.jpg|tv_normal\.png")
+_TV_POSTER_BLACKLIST = re.compile(r"movie_large\.jpg|tv_normal\.jpg|tv_large\.jpg")
+# 豆瓣演员URI中的subject_id
+_SUBJECT_ID_RE = re.compile(r"\?subject_id=(\d+)")
+
+# 按媒体类型查询演员阵容、推荐的DoubanChain方法
+_CREDITS_METHODS = {
+    MediaType.MOVIE.value: "movie_credits",
+    MediaType.TV.value: "tv_credits"
+}
+_RECOMMEND_METHODS = {
+    MediaType.MOVIE.value: "movie_recommend",
+    MediaType.TV.value: "tv_recommend"
+}
+
+# 豆瓣列表数据缓存，10分钟
+_list_cache = TTLCache(maxsize=512, ttl=600)
+# 豆瓣榜单、人物、详情数据缓存，24小时
+_daily_cache = TTLCache(maxsize=512, ttl=86400)
+# 榜单数据客户端缓存时间
+_RANK_CACHE_CONTROL = "private, max-age=3600"
+# 榜单类数据按固定大小分块从豆瓣获取
+_CHUNK_SIZE = 50
+# 分块获取时每页数量上限，限制单次请求访问豆瓣的次数
+_MAX_CHUNKED_COUNT = 100
+# 已知的榜单长度，超出后不再访问豆瓣，10分钟
+_list_ends = TTLCache(maxsize=64, ttl=600)
+# 正在进行中的豆瓣请求，相同请求只访问一次豆瓣
+_inflight: Dict[tuple, asyncio.Task] = {}
+# 同时访问豆瓣的最大请求数，避免触发豆瓣限流
+_douban_semaphore = asyncio.Semaphore(8)
+
+
+async def _douban_call(method: str, cache: TTLCache, **kwargs) -> Any:
+    """
+    在线程池中调用DoubanChain的方法，结果按方法名和参数缓存，失败结果不缓存，
+    缓存未命中时并发的相同请求等待同一次调用的结果
+    :param method:  DoubanChain方法名
+    :param cache:  缓存对象
+    :param kwargs:  方法参数
+    """
+    key: Tuple = (method, *sorted(kwargs.items()))
+    result = cache.get(key)
+    if result is not None:
+        return result
+    task: Optional[asyncio.Task] = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_douban_fetch(method, cache, key, **kwargs))
+        _inflight[key] = task
+        task.add_done_callback(partial(_inflight_done, key))
+    # 单个请求被取消时不影响共享的调用及其它等待者
+    return await asyncio.shield(task)
+
+
+async def _douban_fetch(method: str, cache: TTLCache, key: Tuple, **kwargs) -> Any:
+    """
+    访问豆瓣并缓存非空结果
+    """
+    async with _douban_semaphore:
+        result = await run_in_threadpool(getattr(_douban_chain, method), **kwargs)
+    if result:
+        cache[key] = result
+    return result
+
+
+def _inflight_done(key: Tuple, task: asyncio.Task) -> None:
+    """
+    豆瓣调用结束后移出进行中列表
+    """
+    if _inflight.get(key) is task:
+        _inflight.pop(key, None)
+    # 所有等待者都已取消时避免输出未获取异常的警告
+    if not task.cancelled():
+        task.exception()
+
+
+async def _douban_chunked_call(method: str, cache: TTLCache, page: int, count: int) -> List[dict]:
+    """
+    按固定大小的数据块获取豆瓣榜单数据后切片，不同的分页参数复用已缓存的数据块
+    :param method:  DoubanChain方法名
+    :param cache:  缓存对象
+    :param page:  页码
+    :param count:  每页数量，超过上限时只返回上限数量
+    """
+    if page < 1 or count < 1:
+        return []
+    # 按请求的数量定位起始位置，只限制返回的数量
+    start = (page - 1) * count
+    count = min(count, _MAX_CHUNKED_COUNT)
+    list_end = _list_ends.get(method)
+    if list_end is not None and start >= list_end:
+        return []
+    first_chunk = start // _CHUNK_SIZE
+    last_chunk = (start + count - 1) // _CHUNK_SIZE
+    items = []
+    for chunk_index in range(first_chunk, last_chunk + 1):
+        if list_end is not None and chunk_index * _CHUNK_SIZE >= list_end:
+            break
+        chunk = await _douban_call(method, cache, page=chunk_index + 1, count=_CHUNK_SIZE) or []
+        items.extend(chunk)
+        if len(chunk) < _CHUNK_SIZE:
+            # 数据块不足时已到列表末尾或获取失败，不再获取后续数据块，避免数据错位；
+            # 空数据块可能是获取失败，只将非空的不足数据块记录为列表末尾
+            if chunk:
+                _list_ends[method] = chunk_index * _CHUNK_SIZE + len(chunk)
+            break
+    offset = start - first_chunk * _CHUNK_SIZE
+    return items[offset:offset + count]
+
+
+async def _build_medias(infos: List[dict], poster_blacklist: re.Pattern = None) -> List[dict]:
+    """
+    在线程池中将豆瓣数据转换为媒体信息字典，避免阻塞事件循环
+    :param infos:  豆瓣数据列表
+    :param poster_blacklist:  海报过滤规则，设置时过滤无海报或海报匹配规则的数据
+    """
+    if not infos:
+        return []
+
+    def __build() -> List[dict]:
+        medias: Iterator[MediaInfo] = (MediaInfo(douban_info=info) for info in infos)
+        if not poster_blacklist:
+            return [media.to_dict() for media in medias]
+        return [media.to_dict() for media in medias
+                if media.poster_path
+                and not poster_blacklist.search(media.poster_path)]
+
+    return await run_in_threadpool(__build)
+
+
+def _subject_id(uri: str) -> Optional[str]:
+    """
+    从豆瓣URI中提取subject_id，如'douban://douban.com/celebrity/1316132?subject_id=27503705'
+    """
+    match: Optional[re.Match] = _SUBJECT_ID_RE.search(uri or "")
+    return match.group(1) if match else None
 
 
 @router.get("/img", summary="豆瓣图片代理")
-def douban_img(imgurl: str) -> Any:
+async def douban_img(imgurl: str) -> Any:
     """
     豆瓣图片代理
     """
     if not imgurl:
         return None
-    response = RequestUtils(headers={
-        'Referer': "https://movie.douban.com/"
-    }, ua=settings.USER_AGENT).get_res(url=imgurl)
-    if response:
-        return Response(content=response.content, media_type="image/jpeg")
-    return None
+    response = await run_in_threadpool(RequestUtils(headers={
+        'Referer': "https://movie.douban.com/",
+        'User-Agent': settings.USER_AGENT
+    }, session=_img_session).get_res, url=imgurl, stream=True)
+    if response is None:
+        return None
+    if not response.ok:
+        response.close()
+        return None
+    headers: Dict[str, str] = {"Cache-Control": "max-age=86400"}
+    for name in ["ETag", "Last-Modified"]:
+        if response.headers.get(name):
+            headers[name] = response.headers.get(name)
+    # 内容经过压缩时解码后长度会变化，不转发
+    if response.headers.get("Content-Length") \
+            and not response.headers.get("Content-Encoding"):
+        headers["Content-Length"] = response.headers.get("Content-Length")
+
+    def __iter_content():
+        # 客户端中途断开时也要释放上游连接
+        try:
+            yield from response.iter_content(chunk_size=65536)
+        finally:
+            response.close()
+
+    return StreamingResponse(__iter_content(),
+                             media_type="image/jpeg",
+                             headers=headers)
 
 
 @router.get("/person/{person_id}", summary="人物详情", response_model=schemas.MediaPerson)
-def douban_person(person_id: int,
-                  _: schemas.TokenPayload = Depends(verify_token)) -> Any:
+async def douban_person(person_id: int,
+                        _: schemas.TokenPayload = Depends(verify_token)) -> Any:
     """
     根据人物ID查询人物详情
     """
-    personinfo = DoubanChain().person_detail(person_id=person_id)
+    personinfo = await _douban_call("person_detail", _daily_cache, person_id=person_id)
     if not personinfo:
         return schemas.MediaPerson(source='douban')
     else:
@@ -52,191 +268,194 @@ def douban_person(person_id: int,
 
 
 @router.get("/person/credits/{person_id}", summary="人物参演作品", response_model=List[schemas.MediaInfo])
-def douban_person_credits(person_id: int,
-                          page: int = 1,
-                          _: schemas.TokenPayload = Depends(verify_token)) -> Any:
+async def douban_person_credits(person_id: int,
+                                page: int = 1,
+                                _: schemas.TokenPayload = Depends(verify_token)) -> Any:
     """
     根据人物ID查询人物参演作品
     """
-    works = DoubanChain().person_credits(person_id=person_id, page=page)
+    works = await _douban_call("person_credits", _daily_cache, person_id=person_id, page=page)
     if not works:
         return []
     else:
-        return [MediaInfo(douban_info=work.get("subject")).to_dict() for work in works]
+        return await _build_medias([work.get("subject") for work in works])
 
 
 @router.get("/showing", summary="豆瓣正在热映", response_model=List[schemas.MediaInfo])
-def movie_showing(page: int = 1,
-                  count: int = 30,
-                  _: schemas.TokenPayload = Depends(verify_token)) -> Any:
+async def movie_showing(page: int = 1,
+                        count: int = 30,
+                        _: schemas.TokenPayload = Depends(verify_token)) -> Any:
     """
     浏览豆瓣正在热映
     """
-    movies = DoubanChain().movie_showing(page=page, count=count)
+    movies = await _douban_chunked_call("movie_showing", _list_cache, page=page, count=count)
     if not movies:
         return []
-    medias = [MediaInfo(douban_info=movie) for movie in movies]
-    return [media.to_dict() for media in medias]
+    return await _build_medias(movies)
 
 
 @router.get("/movies", summary="豆瓣电影", response_model=List[schemas.MediaInfo])
-def douban_movies(sort: str = "R",
-                  tags: str = "",
-                  page: int = 1,
-                  count: int = 30,
-                  _: schemas.TokenPayload = Depends(verify_token)) -> Any:
+async def douban_movies(sort: str = "R",
+                        tags: str = "",
+                        page: int = 1,
+                        count: int = 30,
+                        _: schemas.TokenPayload = Depends(verify_token)) -> Any:
     """
     浏览豆瓣电影信息
     """
-    movies = DoubanChain().douban_discover(mtype=MediaType.MOVIE,
-                                           sort=sort, tags=tags, page=page, count=count)
+    movies = await _douban_call("douban_discover", _list_cache, mtype=MediaType.MOVIE,
+                                sort=sort, tags=tags, page=page, count=count)
     if not movies:
         return []
-    medias = [MediaInfo(douban_info=movie) for movie in movies]
-    return [media.to_dict() for media in medias
-            if media.poster_path
-            and "movie_large.jpg" not in media.poster_path
-            and "tv_normal.png" not in media.poster_path]
+    return await _build_medias(movies, poster_blacklist=_MOVIE_POSTER_BLACKLIST)
 
 
 @router.get("/tvs", summary="豆瓣剧集", response_model=List[schemas.MediaInfo])
-def douban_tvs(sort: str = "R",
-               tags: str = "",
-               page: int = 1,
-               count: int = 30,
-               _: schemas.TokenPayload = Depends(verify_token)) -> Any:
+async def douban_tvs(sort: str = "R",
+                     tags: str = "",
+                     page: int = 1,
+                     count: int = 30,
+                     _: schemas.TokenPayload = Depends(verify_token)) -> Any:
     """
     浏览豆瓣剧集信息
     """
-    tvs = DoubanChain().douban_discover(mtype=MediaType.TV,
-                                        sort=sort, tags=tags, page=page, count=count)
+    tvs = await _douban_call("douban_discover", _list_cache, mtype=MediaType.TV,
+                             sort=sort, tags=tags, page=page, count=count)
     if not tvs:
         return []
-    medias = [MediaInfo(douban_info=tv) for tv in tvs]
-    return [media.to_dict() for media in medias
-            if media.poster_path
-            and "movie_large.jpg" not in media.poster_path
-            and "tv_normal.jpg" not in media.poster_path
-            and "tv_large.jpg" not in media.poster_path]
+    return await _build_medias(tvs, poster_blacklist=_TV_POSTER_BLACKLIST)
 
 
 @router.get("/movie_top250", summary="豆瓣电影TOP250", response_model=List[schemas.MediaInfo])
-def movie_top250(page: int = 1,
-                 count: int = 30,
-                 _: schemas.TokenPayload = Depends(verify_token)) -> Any:
+async def movie_top250(response: Response,
+                       page: int = 1,
+                       count: int = 30,
+                       _: schemas.TokenPayload = Depends(verify_token)) -> Any:
     """
     浏览豆瓣剧集信息
     """
-    movies = DoubanChain().movie_top250(page=page, count=count) or []
-    return [MediaInfo(douban_info=movie).to_dict() for movie in movies]
+    movies = await _douban_chunked_call("movie_top250", _daily_cache, page=page, count=count)
+    medias = await _build_medias(movies)
+    # 获取失败时不让客户端缓存
+    if medias:
+        response.headers["Cache-Control"] = _RANK_CACHE_CONTROL
+    return medias
 
 
 @router.get("/tv_weekly_chinese", summary="豆瓣国产剧集周榜", response_model=List[schemas.MediaInfo])
-def tv_weekly_chinese(page: int = 1,
-                      count: int = 30,
-                      _: schemas.TokenPayload = Depends(verify_token)) -> Any:
+async def tv_weekly_chinese(response: Response,
+                            page: int = 1,
+                            count: int = 30,
+                            _: schemas.TokenPayload = Depends(verify_token)) -> Any:
     """
     中国每周剧集口碑榜
     """
-    tvs = DoubanChain().tv_weekly_chinese(page=page, count=count) or []
-    return [MediaInfo(douban_info=tv).to_dict() for tv in tvs]
+    tvs = await _douban_chunked_call("tv_weekly_chinese", _list_cache, page=page, count=count)
+    medias = await _build_medias(tvs)
+    # 获取失败时不让客户端缓存
+    if medias:
+        response.headers["Cache-Control"] = _RANK_CACHE_CONTROL
+    return medias
 
 
 @router.get("/tv_weekly_global", summary="豆瓣全球剧集周榜", response_model=List[schemas.MediaInfo])
-def tv_weekly_global(page: int = 1,
-                     count: int = 30,
-                     _: schemas.TokenPayload = Depends(verify_token)) -> Any:
+async def tv_weekly_global(response: Response,
+                           page: int = 1,
+                           count: int = 30,
+                           _: schemas.TokenPayload = Depends(verify_token)) -> Any:
     """
     全球每周剧集口碑榜
     """
-    tvs = DoubanChain().tv_weekly_global(page=page, count=count) or []
-    return [MediaInfo(douban_info=tv).to_dict() for tv in tvs]
+    tvs = await _douban_chunked_call("tv_weekly_global", _list_cache, page=page, count=count)
+    medias = await _build_medias(tvs)
+    # 获取失败时不让客户端缓存
+    if medias:
+        response.headers["Cache-Control"] = _RANK_CACHE_CONTROL
+    return medias
 
 
 @router.get("/tv_animation", summary="豆瓣动画剧集", response_model=List[schemas.MediaInfo])
-def tv_animation(page: int = 1,
-                 count: int = 30,
-                 _: schemas.TokenPayload = Depends(verify_token)) -> Any:
+async def tv_animation(response: Response,
+                       page: int = 1,
+                       count: int = 30,
+                       _: schemas.TokenPayload = Depends(verify_token)) -> Any:
     """
     热门动画剧集
     """
-    tvs = DoubanChain().tv_animation(page=page, count=count) or []
-    return [MediaInfo(douban_info=tv).to_dict() for tv in tvs]
+    tvs = await _douban_chunked_call("tv_animation", _list_cache, page=page, count=count)
+    medias = await _build_medias(tvs)
+    # 获取失败时不让客户端缓存
+    if medias:
+        response.headers["Cache-Control"] = _RANK_CACHE_CONTROL
+    return medias
 
 
 @router.get("/movie_hot", summary="豆瓣热门电影", response_model=List[schemas.MediaInfo])
-def movie_hot(page: int = 1,
-              count: int = 30,
-              _: schemas.TokenPayload = Depends(verify_token)) -> Any:
+async def movie_hot(page: int = 1,
+                    count: int = 30,
+                    _: schemas.TokenPayload = Depends(verify_token)) -> Any:
     """
     热门电影
     """
-    movies = DoubanChain().movie_hot(page=page, count=count) or []
-    return [MediaInfo(douban_info=movie).to_dict() for movie in movies]
+    movies = await _douban_chunked_call("movie_hot", _list_cache, page=page, count=count)
+    return await _build_medias(movies)
 
 
 @router.get("/tv_hot", summary="豆瓣热门电视剧", response_model=List[schemas.MediaInfo])
-def tv_hot(page: int = 1,
-           count: int = 30,
-           _: schemas.TokenPayload = Depends(verify_token)) -> Any:
+async def tv_hot(page: int = 1,
+                 count: int = 30,
+                 _: schemas.TokenPayload = Depends(verify_token)) -> Any:
     """
     热门电视剧
     """
-    tvs = DoubanChain().tv_hot(page=page, count=count) or []
-    return [MediaInfo(douban_info=tv).to_dict() for tv in tvs]
+    tvs = await _douban_chunked_call("tv_hot", _list_cache, page=page, count=count)
+    return await _build_medias(tvs)
 
 
 @router.get("/credits/{doubanid}/{type_name}", summary="豆瓣演员阵容", response_model=List[schemas.MediaPerson])
-def douban_credits(doubanid: str,
-                   type_name: str,
-                   page: int = 1,
-                   _: schemas.TokenPayload = Depends(verify_token)) -> Any:
+async def douban_credits(doubanid: str,
+                         type_name: str,
+                         page: int = 1,
+                         _: schemas.TokenPayload = Depends(verify_token)) -> Any:
     """
     根据豆瓣ID查询演员阵容，type_name: 电影/电视剧
     """
-    mediatype = MediaType(type_name)
-    if mediatype == MediaType.MOVIE:
-        doubaninfos = DoubanChain().movie_credits(doubanid=doubanid, page=page)
-    elif mediatype == MediaType.TV:
-        doubaninfos = DoubanChain().tv_credits(doubanid=doubanid, page=page)
-    else:
+    method = _CREDITS_METHODS.get(type_name)
+    if not method:
         return []
+    doubaninfos = await _douban_call(method, _daily_cache, doubanid=doubanid, page=page)
     if not doubaninfos:
         return []
     else:
-        # 更新豆瓣演员信息中的ID，从URI中提取'douban://douban.com/celebrity/1316132?subject_id=27503705' subject_id
-        for doubaninfo in doubaninfos:
-            doubaninfo['id'] = doubaninfo.get('uri', '').split('?subject_id=')[-1]
-        return [schemas.MediaPerson(source='douban', **doubaninfo) for doubaninfo in doubaninfos]
+        # 豆瓣演员信息中的ID从URI中提取，不修改缓存中的原始数据
+        return [schemas.MediaPerson(source='douban', **{**doubaninfo, "id": _subject_id(doubaninfo.get('uri'))})
+                for doubaninfo in doubaninfos]
 
 
 @router.get("/recommend/{doubanid}/{type_name}", summary="豆瓣推荐电影/电视剧", response_model=List[schemas.MediaInfo])
-def douban_recommend(doubanid: str,
-                     type_name: str,
-                     _: schemas.TokenPayload = Depends(verify_token)) -> Any:
+async def douban_recommend(doubanid: str,
+                           type_name: str,
+                           _: schemas.TokenPayload = Depends(verify_token)) -> Any:
     """
     根据豆瓣ID查询推荐电影/电视剧，type_name: 电影/电视剧
     """
-    mediatype = MediaType(type_name)
-    if mediatype == MediaType.MOVIE:
-        doubaninfos = DoubanChain().movie_recommend(doubanid=doubanid)
-    elif mediatype == MediaType.TV:
-        doubaninfos = DoubanChain().tv_recommend(doubanid=doubanid)
-    else:
+    method = _RECOMMEND_METHODS.get(type_name)
+    if not method:
         return []
+    doubaninfos = await _douban_call(method, _daily_cache, doubanid=doubanid)
     if not doubaninfos:
         return []
     else:
-        return [MediaInfo(douban_info=doubaninfo).to_dict() for doubaninfo in doubaninfos]
+        return await _build_medias(doubaninfos)
 
 
 @router.get("/{doubanid}", summary="查询豆瓣详情", response_model=schemas.MediaInfo)
-def douban_info(doubanid: str,
-                _: schemas.TokenPayload = Depends(verify_token)) -> Any:
+async def douban_info(doubanid: str,
+                      _: schemas.TokenPayload = Depends(verify_token)) -> Any:
     """
     根据豆瓣ID查询豆瓣媒体信息
     """
-    doubaninfo = DoubanChain().douban_info(doubanid=doubanid)
+    doubaninfo = await _douban_call("douban_info", _daily_cache, doubanid=doubanid)
     if doubaninfo:
         return MediaInfo(douban_info=doubaninfo).to_dict()
     else:
@@ -1,5 +1,6 @@
 import re
-from dataclasses import dataclass, field, asdict
+from copy import deepcopy
+from dataclasses import dataclass, field, asdict, fields
 from typing import List, Dict, Any, Tuple
 
 from app.core.config import settings
@@ -710,13 +711,14 @@ class MediaInfo:
         """
         返回字典
         """
-        dicts = asdict(self)
+        # 原始数据不输出，无需深拷贝
+        dicts = {
+            f.name: None if f.name in ("tmdb_info", "douban_info", "bangumi_info")
+            else deepcopy(getattr(self, f.name)) for f in fields(self)
+        }
         dicts["type"] = self.type.value if self.type else None
         dicts["detail_link"] = self.detail_link
         dicts["title_year"] = self.title_year
-        dicts["tmdb_info"] = None
-        dicts["douban_info"] = None
-        dicts["bangumi_info"] = None
         return dicts
 
     def clear(self):
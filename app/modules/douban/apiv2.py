@@ -2,12 +2,16 @@
 import base64
 import hashlib
 import hmac
+import time
 from datetime import datetime
 from functools import lru_cache
-from random import choice
+from random import choice, random
 from urllib import parse
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from app.core.config import settings
 from app.utils.http import RequestUtils
@@ -155,9 +159,27 @@ class DoubanApi(metaclass=Singleton):
     _base_url = "https://frodo.douban.com/api/v2"
     _api_url = "https://api.douban.com/v2"
     _session = None
+    # 触发限流时的最大重试次数
+    _rate_limit_retries = 3
 
     def __init__(self):
         self._session = requests.Session()
+        # 接口并发访问时复用连接，连接失败、限流或服务端错误时退避重试，
+        # 读取超时不重试，不按Retry-After长时间等待，重试耗尽后返回最后一次的响应
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50,
+                              max_retries=Retry(total=None,
+                                                connect=3,
+                                                read=0,
+                                                status=3,
+                                                other=0,
+                                                backoff_factor=0.5,
+                                                backoff_jitter=0.5,
+                                                status_forcelist=[429, 500, 502, 503, 504],
+                                                allowed_methods=["GET"],
+                                                raise_on_status=False,
+                                                respect_retry_after_header=False))
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
 
     @classmethod
     def __sign(cls, url: str, ts: int, method='GET') -> str:
@@ -195,13 +217,25 @@ class DoubanApi(metaclass=Singleton):
             '_ts': ts,
             '_sig': self.__sign(url=req_url, ts=ts)
         })
-        with RequestUtils(
+        resp = None
+        for attempt in range(self._rate_limit_retries + 1):
+            if attempt:
+                # 触发豆瓣限流时按指数退避并加入随机抖动后重试
+                time.sleep(0.5 * 2 ** (attempt - 1) + random())
+            resp = RequestUtils(
                 ua=choice(self._user_agents),
                 session=self._session
-        ).get_res(url=req_url, params=params) as resp:
-            if resp is not None and resp.status_code == 400 and "rate_limit" in resp.text:
-                return resp.json()
-            return resp.json() if resp else {}
+            ).get_res(url=req_url, params=params)
+            if resp is None \
+                    or resp.status_code != 400 \
+                    or "rate_limit" not in resp.text:
+                break
+        if resp is None:
+            return {}
+        with resp:
+            if resp.status_code == 400 and "rate_limit" in resp.text:
+                return orjson.loads(resp.content)
+            return orjson.loads(resp.content) if resp else {}
 
     @lru_cache(maxsize=settings.CACHE_CONF.get('douban'))
     def __post(self, url: str, **kwargs) -> dict:
@@ -229,8 +263,8 @@ class DoubanApi(metaclass=Singleton):
             session=self._session,
         ).post_res(url=req_url, data=params)
         if resp.status_code == 400 and "rate_limit" in resp.text:
-            return resp.json()
-        return resp.json() if resp else {}
+            return orjson.loads(resp.content)
+        return orjson.loads(resp.content) if resp else {}
 
     def imdbid(self, imdbid: str,
                ts=datetime.strftime(datetime.now(), '%Y%m%d')):
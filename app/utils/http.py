@@ -98,7 +98,8 @@ class RequestUtils:
                 data: Any = None,
                 json: dict = None,
                 allow_redirects: bool = True,
-                raise_exception: bool = False
+                raise_exception: bool = False,
+                stream: bool = False
                 ) -> Optional[Response]:
         try:
             if self._session:
@@ -112,7 +113,7 @@ class RequestUtils:
                                          cookies=self._cookies,
                                          timeout=self._timeout,
                                          allow_redirects=allow_redirects,
-                                         stream=False)
+                                         stream=stream)
             else:
                 return requests.get(url,
                                     params=params,
@@ -124,7 +125,7 @@ class RequestUtils:
                                     cookies=self._cookies,
                                     timeout=self._timeout,
                                     allow_redirects=allow_redirects,
-                                    stream=False)
+                                    stream=stream)
         except requests.exceptions.RequestException:
             if raise_exception:
                 raise requests.exceptions.RequestException
@@ -1,5 +1,6 @@
 import unittest
 
+from tests.test_douban import DoubanChunkedTest, DoubanSingleFlightTest
 from tests.test_metainfo import MetaInfoTest
 
 if __name__ == '__main__':
@@ -8,6 +9,11 @@ if __name__ == '__main__':
     # 测试名称识别
     suite.addTest(MetaInfoTest('test_metainfo'))
 
+    # 测试豆瓣榜单分块获取
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(DoubanChunkedTest))
+    # 测试豆瓣相同请求合并
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(DoubanSingleFlightTest))
+
     # 运行测试
     runner = unittest.TextTestRunner()
     runner.run(suite)
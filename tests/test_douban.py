@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+with patch("app.chain.douban.DoubanChain"):
+    from app.api.endpoints import douban
+
+
+class StubDoubanChain:
+    """
+    模拟豆瓣处理链，按页码、数量返回固定的榜单数据
+    """
+
+    def __init__(self, total: int = 250, fail_pages: tuple = (), short_pages: dict = None, delay: float = 0):
+        self.items = [{"id": str(i)} for i in range(total)]
+        self.fail_pages = fail_pages
+        self.short_pages = short_pages or {}
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def movie_top250(self, page: int = 1, count: int = 30):
+        with self._lock:
+            self.calls.append((page, count))
+        if self.delay:
+            time.sleep(self.delay)
+        if page in self.fail_pages:
+            return []
+        items = self.items[(page - 1) * count:page * count]
+        if page in self.short_pages:
+            items = items[:self.short_pages[page]]
+        return items
+
+    def person_detail(self, person_id: int):
+        with self._lock:
+            self.calls.append((person_id,))
+        time.sleep(self.delay)
+        raise ValueError("douban error")
+
+
+class DoubanChunkedTest(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        douban._list_cache.clear()
+        douban._daily_cache.clear()
+        douban._list_ends.clear()
+        douban._inflight.clear()
+        douban._douban_semaphore = asyncio.Semaphore(8)
+        self.chain = StubDoubanChain()
+        douban._douban_chain = self.chain
+
+    async def chunked(self, page: int, count: int):
+        return await douban._douban_chunked_call("movie_top250", douban._daily_cache, page=page, count=count)
+
+    async def test_slicing(self):
+        self.chain = StubDoubanChain(total=245)
+        douban._douban_chain = self.chain
+        for page in range(1, 12):
+            for count in (1, 7, 10, 30, 50, 60, 100):
+                self.assertEqual(await self.chunked(page, count),
+                                 self.chain.items[(page - 1) * count:page * count],
+                                 msg=f"page={page} count={count}")
+        # 数据块均按固定大小获取，且每块只获取一次
+        self.assertTrue(all(count == douban._CHUNK_SIZE for _, count in self.chain.calls))
+        self.assertEqual(len(self.chain.calls), len(set(self.chain.calls)))
+
+    async def test_chunk_reuse(self):
+        await self.chunked(1, 10)
+        await self.chunked(2, 10)
+        await self.chunked(5, 10)
+        self.assertEqual(self.chain.calls, [(1, douban._CHUNK_SIZE)])
+
+    async def test_invalid_page(self):
+        self.assertEqual(await self.chunked(0, 30), [])
+        self.assertEqual(await self.chunked(1, 0), [])
+        self.assertEqual(self.chain.calls, [])
+
+    async def test_count_clamped(self):
+        result = await self.chunked(1, 5000)
+        self.assertEqual(result, self.chain.items[:douban._MAX_CHUNKED_COUNT])
+        self.assertEqual(len(self.chain.calls), douban._MAX_CHUNKED_COUNT // douban._CHUNK_SIZE)
+        # 起始位置按请求的数量计算
+        self.assertEqual(await self.chunked(2, 150), self.chain.items[150:250])
+
+    async def test_short_chunk(self):
+        self.chain = StubDoubanChain(total=500, short_pages={2: 30})
+        douban._douban_chain = self.chain
+        self.assertEqual(await self.chunked(1, 100), self.chain.items[:80])
+        self.assertEqual(self.chain.calls, [(1, 50), (2, 50)])
+        # 已知列表末尾，后续分页不再访问豆瓣
+        self.assertEqual(await self.chunked(3, 30), self.chain.items[60:80])
+        self.assertEqual(await self.chunked(2, 100), [])
+        self.assertEqual(await self.chunked(4, 30), [])
+        self.assertEqual(self.chain.calls, [(1, 50), (2, 50)])
+
+    async def test_failed_chunk(self):
+        self.chain = StubDoubanChain(total=500, fail_pages=(2,))
+        douban._douban_chain = self.chain
+        self.assertEqual(await self.chunked(2, 40), self.chain.items[40:50])
+        self.assertEqual(self.chain.calls, [(1, 50), (2, 50)])
+        # 失败的数据块不缓存，也不记录为列表末尾
+        self.assertNotIn(("movie_top250", ("count", 50), ("page", 2)), douban._daily_cache)
+        self.assertNotIn("movie_top250", douban._list_ends)
+        await self.chunked(3, 40)
+        self.assertEqual(self.chain.calls, [(1, 50), (2, 50), (2, 50)])
+
+    async def test_first_chunk_failed(self):
+        self.chain = StubDoubanChain(fail_pages=(1,))
+        douban._douban_chain = self.chain
+        self.assertEqual(await self.chunked(1, 30), [])
+        # 无法区分失败与列表末尾时不记录末尾，下次仍会重新获取
+        self.assertNotIn("movie_top250", douban._list_ends)
+        await self.chunked(1, 30)
+        self.assertEqual(self.chain.calls, [(1, 50), (1, 50)])
+
+    async def test_end_of_list(self):
+        self.chain = StubDoubanChain(total=230)
+        douban._douban_chain = self.chain
+        self.assertEqual(await self.chunked(8, 30), self.chain.items[210:230])
+        self.assertEqual(self.chain.calls, [(5, 50)])
+        self.assertEqual(douban._list_ends.get("movie_top250"), 230)
+        self.assertEqual(await self.chunked(8, 30), self.chain.items[210:230])
+        self.assertEqual(await self.chunked(9, 30), [])
+        self.assertEqual(self.chain.calls, [(5, 50)])
+
+
+class DoubanSingleFlightTest(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        douban._list_cache.clear()
+        douban._daily_cache.clear()
+        douban._inflight.clear()
+        douban._douban_semaphore = asyncio.Semaphore(8)
+        self.chain = StubDoubanChain(delay=0.2)
+        douban._douban_chain = self.chain
+
+    async def test_single_flight(self):
+        results = await asyncio.gather(*[
+            douban._douban_call("movie_top250", douban._daily_cache, page=1, count=50) for _ in range(5)
+        ])
+        self.assertEqual(len(self.chain.calls), 1)
+        for result in results:
+            self.assertEqual(result, self.chain.items[:50])
+        self.assertEqual(douban._inflight, {})
+
+    async def test_cancel_waiter(self):
+        tasks = [asyncio.ensure_future(
+            douban._douban_call("movie_top250", douban._daily_cache, page=1, count=50)
+        ) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        tasks[1].cancel()
+        self.assertEqual(await tasks[0], self.chain.items[:50])
+        self.assertEqual(await tasks[2], self.chain.items[:50])
+        with self.assertRaises(asyncio.CancelledError):
+            await tasks[1]
+        self.assertEqual(len(self.chain.calls), 1)
+
+    async def test_cancel_first_caller(self):
+        tasks = [asyncio.ensure_future(
+            douban._douban_call("movie_top250", douban._daily_cache, page=1, count=50)
+        ) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        tasks[0].cancel()
+        self.assertEqual(await tasks[1], self.chain.items[:50])
+        self.assertEqual(await tasks[2], self.chain.items[:50])
+        with self.assertRaises(asyncio.CancelledError):
+            await tasks[0]
+        self.assertEqual(len(self.chain.calls), 1)
+        # 被取消的请求不影响结果缓存
+        self.assertEqual(douban._daily_cache.get(("movie_top250", ("count", 50), ("page", 1))),
+                         self.chain.items[:50])
+
+    async def test_error_propagation(self):
+        results = await asyncio.gather(*[
+            douban._douban_call("person_detail", douban._daily_cache, person_id=1) for _ in range(3)
+        ], return_exceptions=True)
+        self.assertEqual(len(self.chain.calls), 1)
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+        self.assertEqual(douban._inflight, {})
+        self.assertEqual(len(douban._daily_cache), 0)